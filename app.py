@@ -2,30 +2,124 @@ from flask import Flask, request, abort
 import os
 import json
 from dotenv import load_dotenv
-import traceback
 import time
+import logging
+import logging.handlers
+import atexit
+from contextlib import contextmanager
 import re
 import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from datetime import datetime, timezone
 
 from linebot import LineBotApi, WebhookHandler
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage, StickerMessage  
 import firebase_admin
 from firebase_admin import credentials, firestore
 from openai import OpenAI
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession
 import re  # 加上這個才能使用 regex
 
 
 # ====== 初始化設定 ======
 load_dotenv()
+# 訊息內容等逐則紀錄用 DEBUG，正式環境預設 INFO 時不會格式化也不會送進 Cloud Logging
+# 處理請求的執行緒只把紀錄丟進佇列，寫 stderr 交給背景 listener，避免高峰時卡在 I/O
+# （訊息與 traceback 仍在呼叫端組好；時間、等級等前綴只由 listener 這邊的 formatter 加一次）
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter(
+    "%(asctime)s %(levelname)s %(name)s [%(threadName)s] %(message)s"
+))
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+log_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+# root 維持 WARNING，第三方套件（httpx 每次請求一行等）的 INFO 不會洗版；LOG_LEVEL 只套用在本程式的 logger
+logging.basicConfig(
+    level=logging.WARNING,
+    handlers=[log_queue_handler],
+)
+logger = logging.getLogger("anxin")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+# ====== 計時：記錄每段外部呼叫耗時，方便找出延遲來源 ======
+@contextmanager
+def span(name, user_id=""):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        # 每則訊息會有好幾段，平常不輸出，查延遲時設 LOG_LEVEL=DEBUG
+        logger.debug("⏱️ %s user_id=%s %.1fms", name, user_id, (time.perf_counter() - start) * 1000)
+
+# ====== 環境變數：啟動時一次檢查並讀取，缺少時立刻失敗（不要等到第一則訊息才出錯） ======
+REQUIRED_ENV_VARS = ["CHANNEL_ACCESS_TOKEN", "CHANNEL_SECRET", "OPENAI_API_KEY", "GOOGLE_SHEETS_KEY"]
+
+def validate_env_vars():
+    missing = [name for name in REQUIRED_ENV_VARS if not os.getenv(name)]
+    if not (os.getenv("FIREBASE_CREDENTIALS") or os.getenv("FIREBASE_CREDENTIALS_PATH")):
+        missing.append("FIREBASE_CREDENTIALS（或 FIREBASE_CREDENTIALS_PATH）")
+    if missing:
+        raise RuntimeError(f"缺少必要的環境變數：{', '.join(missing)}")
+
+validate_env_vars()
+CHANNEL_ACCESS_TOKEN = os.environ["CHANNEL_ACCESS_TOKEN"]
+CHANNEL_SECRET = os.environ["CHANNEL_SECRET"]
+OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+# 同時處理訊息的 worker 數量（也是 OpenAI/Firestore/LINE 併發上限），各連線池與執行緒池依此設定大小
+WORKER_COUNT = int(os.getenv("WORKER_THREADS", "8"))
+
+# ====== LINE API：SDK 預設每次呼叫都用 requests.post 另開連線，改用共用 Session 保持連線 ======
+class PooledRequestsHttpClient(RequestsHttpClient):
+    def __init__(self, timeout=RequestsHttpClient.DEFAULT_TIMEOUT, pool_maxsize=WORKER_COUNT):
+        super().__init__(timeout=timeout)
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=pool_maxsize))
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(
+            url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self.session.delete(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self.session.put(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
 app = Flask(__name__)
-line_bot_api = LineBotApi(os.getenv('CHANNEL_ACCESS_TOKEN'))
-handler = WebhookHandler(os.getenv('CHANNEL_SECRET'))
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN, http_client=PooledRequestsHttpClient)
+handler = WebhookHandler(CHANNEL_SECRET)
+
+# ====== 背景工作佇列（webhook 只負責排入，由固定數量的 worker 執行） ======
+JOB_QUEUE_MAXSIZE = 1000
+MESSAGE_DEBOUNCE_SECONDS = float(os.getenv("MESSAGE_DEBOUNCE_SECONDS", "0.5"))
 
-user_lock = {}
+job_queue = queue.Queue(maxsize=JOB_QUEUE_MAXSIZE)
+busy_users = set()  # 已有訊息在佇列中或處理中的使用者
+pending_messages = {}  # 處理中時又收到的訊息：user_id -> [(user_message, event)]
+busy_users_lock = threading.Lock()
+
+# 回覆 LINE 時同時進行的 Firestore 寫入
+io_executor = ThreadPoolExecutor(max_workers=WORKER_COUNT)
 
 DEFAULT_SYSTEM_PROMPT="""
 ⚠️ 重要限制：
@@ -118,52 +212,331 @@ DEFAULT_SYSTEM_PROMPT="""
 
 """
 
+# 一般模式的 system 訊息固定不變，載入時建立一次；內容勿插入使用者資料或時間，才能命中 prompt cache
+DEFAULT_SYSTEM_MESSAGE = {"role": "system", "content": DEFAULT_SYSTEM_PROMPT}
+
 # ====== Firebase 初始化 ======
 def get_firebase_credentials_from_env():
+    # 優先使用掛載的金鑰檔（例如 Secret Manager 掛載成檔案），省去解析大型環境變數
+    credentials_path = os.getenv("FIREBASE_CREDENTIALS_PATH")
+    if credentials_path:
+        logger.info("✅ 從檔案讀取 Firebase 金鑰：%s", credentials_path)
+        return credentials.Certificate(credentials_path)
+
     firebase_credentials = os.getenv("FIREBASE_CREDENTIALS")
     service_account_info = json.loads(firebase_credentials)
-    print("✅ 成功從環境變數讀取 Firebase 金鑰")
+    logger.info("✅ 成功從環境變數讀取 Firebase 金鑰")
     return credentials.Certificate(service_account_info)
 
-firebase_cred = get_firebase_credentials_from_env()
-firebase_admin.initialize_app(firebase_cred)
-db = firestore.client()
+# ====== 外部服務 client（第一次使用時才初始化，加快冷啟動） ======
+_db = None
+_db_lock = threading.Lock()
+
+def get_db():
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                # 開發模式重新載入時 app 已存在，不再重複初始化
+                if not firebase_admin._apps:
+                    firebase_admin.initialize_app(get_firebase_credentials_from_env())
+                _db = firestore.client()
+    return _db
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+def get_openai_client():
+    global _openai_client
+    if _openai_client is None:
+        with _openai_client_lock:
+            if _openai_client is None:
+                # 共用一個 HTTP/2 連線池，避免每次呼叫 OpenAI 都重新握手
+                http_client = httpx.Client(
+                    http2=True,
+                    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50, keepalive_expiry=60.0),
+                    timeout=httpx.Timeout(60.0, connect=5.0),
+                )
+                _openai_client = OpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+    return _openai_client
 
 def get_gsheet_client():
     gsheet_credentials = os.getenv("GOOGLE_SHEETS_KEY")
     info = json.loads(gsheet_credentials)
     scopes = ["https://www.googleapis.com/auth/spreadsheets"]
     creds = Credentials.from_service_account_info(info, scopes=scopes)
-    return gspread.authorize(creds)
-
-gc = get_gsheet_client()
-sheet = gc.open_by_key("15frK46I_1OoPhlcJPBMyH53AWNkqhPT_8bS6igbi2_4")
-worksheet = sheet.worksheet("sleep_diary")
+    # 共用一個保持連線的 session，連線池大小跟著 worker 數量，同時寫入日記時不必另開連線
+    session = AuthorizedSession(creds)
+    session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=WORKER_COUNT))
+    return gspread.Client(auth=creds, session=session)
+
+_worksheet = None
+_worksheet_lock = threading.Lock()
+
+def get_worksheet():
+    global _worksheet
+    if _worksheet is None:
+        with _worksheet_lock:
+            if _worksheet is None:
+                gc = get_gsheet_client()
+                sheet = gc.open_by_key("15frK46I_1OoPhlcJPBMyH53AWNkqhPT_8bS6igbi2_4")
+                _worksheet = sheet.worksheet("sleep_diary")
+    return _worksheet
+
+
+# ====== 程序內 TTL 快取（LRU 淘汰，執行緒安全） ======
+class TTLCache:
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+# 只快取使用者文件欄位（回顧代碼、顯示名稱），對話紀錄每次都從 Firestore 讀取：
+# 多個 Cloud Run instance 時，其他 instance 處理過的對話不會漏掉；回顧狀態最多延遲 TTL 秒
+user_state_cache = TTLCache(ttl=60, maxsize=10000)
+
+
+# ====== 回顧 prompt（研究人員設定的靜態內容，快取 10 分鐘） ======
+review_prompt_cache = TTLCache(ttl=600, maxsize=100)
+
+# 回傳代碼對應的 prompt；文件不存在時回傳 None。已經讀到的 prompt_doc 可直接傳入
+def get_review_prompt(review_code, prompt_doc=None):
+    prompt = review_prompt_cache.get(review_code)
+    if prompt is not None:
+        return prompt
+    if prompt_doc is None:
+        prompt_doc = get_db().collection("review_prompts").document(review_code).get(field_paths=["prompt"])
+    if not prompt_doc.exists:
+        return None
+    prompt = prompt_doc.to_dict().get("prompt", "")
+    review_prompt_cache.set(review_code, prompt)
+    return prompt
+
+
+# ====== 睡眠日記列索引：(user_id, 日期) -> 列號，不必每次回報都下載整張表 ======
+DIARY_ROW_INDEX_TTL = 600
+diary_row_index = {}
+diary_row_index_loaded_at = 0.0
+diary_row_index_lock = threading.Lock()
+# 查列號到寫入整段序列化：同一天的兩份回報同時找不到列時，不會各自新增一列
+diary_write_lock = threading.Lock()
+
+# 欄位位置固定，與寫入時的 new_row 一致：C 欄 user_id、D 欄日期、E～G 早上、H～I 晚上
+DIARY_USER_COL = 2
+DIARY_DATE_COL = 3
+
+def refresh_diary_row_index(worksheet):
+    global diary_row_index, diary_row_index_loaded_at
+    # get_all_values 只回傳字串列表，不需像 get_all_records 一樣逐列建 dict
+    values = worksheet.get_all_values()
+    index = {}
+    for row_number, row in enumerate(values[1:], start=2):
+        if len(row) > DIARY_DATE_COL:
+            index.setdefault((row[DIARY_USER_COL], row[DIARY_DATE_COL]), row_number)
+    diary_row_index = index
+    diary_row_index_loaded_at = time.monotonic()
+
+# 找不到或索引過期時才重新下載整張表（可能是其他 instance 或研究人員新增的列）
+def find_diary_row(worksheet, user_id, date_str):
+    key = (user_id, date_str)
+    with diary_row_index_lock:
+        expired = time.monotonic() - diary_row_index_loaded_at > DIARY_ROW_INDEX_TTL
+        if expired or key not in diary_row_index:
+            refresh_diary_row_index(worksheet)
+            return diary_row_index.get(key)
+
+        # 研究人員可能排序、插入或刪除列：寫入前先確認 C、D 欄仍是同一位使用者與日期，不符就重建索引
+        row_number = diary_row_index[key]
+        if worksheet.get(f"C{row_number}:D{row_number}") == [[user_id, date_str]]:
+            return row_number
+        logger.info("🔄 日記列 %s 已變動，重新建立索引", row_number)
+        refresh_diary_row_index(worksheet)
+        return diary_row_index.get(key)
+
+UPDATED_ROW_RE = re.compile(r"![A-Z]+(\d+)")
+
+def append_diary_row(worksheet, user_id, date_str, new_row):
+    response = worksheet.append_row(new_row)
+    # updatedRange 形如 "sleep_diary!A12:I12"，記下新列的列號
+    updated_range = response.get("updates", {}).get("updatedRange", "")
+    row_match = UPDATED_ROW_RE.search(updated_range)
+    if row_match:
+        with diary_row_index_lock:
+            diary_row_index[(user_id, date_str)] = int(row_match.group(1))
+
+
+# ====== 對話紀錄（users/{uid}/messages 子集合） ======
+# 處理訊息時需要的使用者文件欄位（不含舊版的 messages 陣列）
+USER_DOC_FIELDS = ["current_review_code", "display_name"]
+HISTORY_FETCH_LIMIT = 20
+
+# 讀取最近的對話紀錄（由舊到新）；尚未搬到子集合的舊紀錄從文件內的 messages 陣列補足
+def load_recent_messages(user_ref, user_exists):
+    snaps = (
+        user_ref.collection("messages")
+        .order_by("create_at", direction=firestore.Query.DESCENDING)
+        .limit(HISTORY_FETCH_LIMIT)
+        .get()
+    )
+    messages = [snap.to_dict() for snap in reversed(snaps)]
+    missing = HISTORY_FETCH_LIMIT - len(messages)
+    if missing > 0 and user_exists:
+        # 只有子集合還不足一個視窗時才需要舊陣列
+        messages = load_legacy_messages(user_ref)[-missing:] + messages
+    return messages
+
+# 舊版 messages 陣列已不再寫入，每位使用者只讀一次（沒有舊紀錄也記成空列表），之後直接用記憶體中的
+legacy_messages_cache = TTLCache(ttl=86400, maxsize=10000)
+
+def load_legacy_messages(user_ref):
+    legacy = legacy_messages_cache.get(user_ref.id)
+    if legacy is None:
+        legacy_data = user_ref.get(field_paths=["messages"]).to_dict() or {}
+        legacy = legacy_data.get("messages", [])[-HISTORY_FETCH_LIMIT:]
+        legacy_messages_cache.set(user_ref.id, legacy)
+    return legacy
+
+
+# ====== LINE 顯示名稱（快取在 Firestore 使用者文件） ======
+def get_display_name(user_id, user_ref, user_data):
+    display_name = user_data.get("display_name")
+    if not display_name:
+        display_name = line_bot_api.get_profile(user_id).display_name
+        user_ref.set({"display_name": display_name}, merge=True)
+        user_data["display_name"] = display_name
+    return display_name
+
+
+# ====== OpenAI 請求節流（token bucket），突發流量先在本地排隊，而不是打到 429 再重試 ======
+class RateLimiter:
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60.0
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            # 額度不足時預約下一個空檔，鎖外再等待
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+openai_rate_limiter = RateLimiter(per_minute=int(os.getenv("OPENAI_RPM", "500")), burst=WORKER_COUNT)
 
 
 # ====== GPT 回應處理（ChatCompletion） ======
+RETRY_REPLY_TEXT = "❕請稍後再傳一次訊息"
+
 def run_chat_completion(messages):
     try:
-        response = client.chat.completions.create(
+        openai_rate_limiter.acquire()
+        response = get_openai_client().chat.completions.create(
             model="gpt-4o",
             messages=messages,
             max_tokens=300,
             temperature=0.8,
             stream=False
         )
+        usage = response.usage
+        details = getattr(usage, "prompt_tokens_details", None) if usage else None
+        if details is not None:
+            logger.debug("🧮 prompt_tokens=%s cached_tokens=%s", usage.prompt_tokens, details.cached_tokens)
         return response.choices[0].message.content.strip()
-    except Exception as e:
-        print("❌ ChatCompletion 錯誤：")
-        traceback.print_exc()
-        return "❕請稍後再傳一次訊息"
+    except Exception:
+        logger.exception("❌ ChatCompletion 錯誤")
+        return RETRY_REPLY_TEXT
 
 # ====== 清除 markdown 格式（防止 LINE 亂碼） ======
+# 依序處理粗體、斜體、行內程式碼；順序不可合併，***粗斜體*** 要靠前一輪剩下的 * 再被下一輪清掉
+MARKDOWN_BOLD_RE = re.compile(r'\*\*(.*?)\*\*')
+MARKDOWN_ITALIC_RE = re.compile(r'\*(.*?)\*')
+MARKDOWN_CODE_RE = re.compile(r'`(.*?)`')
+
 def remove_markdown(text):
-    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
-    text = re.sub(r'\*(.*?)\*', r'\1', text)
-    text = re.sub(r'`(.*?)`', r'\1', text)
+    # 大部分回覆沒有任何 markdown 符號，直接略過 regex
+    if "*" not in text and "`" not in text:
+        return text
+    text = MARKDOWN_BOLD_RE.sub(r'\1', text)
+    text = MARKDOWN_ITALIC_RE.sub(r'\1', text)
+    text = MARKDOWN_CODE_RE.sub(r'\1', text)
     return text
 
+# ====== 固定回覆（模組載入時建立一次，重複使用） ======
+STICKER_REPLY = TextSendMessage(text="謝謝你的貼圖！我無法直接回貼圖～✨ 有想聊睡眠拖延的內容，歡迎告訴我！")
+ERROR_REPLY = TextSendMessage(text="❗安昕暫時無法使用，請稍後再試")
+
+# ====== 忽略含特定關鍵字的訊息（圖文選單等自動訊息） ======
+SKIP_KEYWORDS = [
+    "我要填寫睡眠日記～",
+    "第一次睡眠回顧將於4/27開放～",
+    "第二次睡眠回顧將於5/4開放～",
+    "第三次睡眠回顧將於5/11開放～","本實驗於4/21開始～"
+]
+
+# ====== 回覆切段：依句尾切開再組成不超過 200 字的段落，最多 5 則（LINE 單次回覆上限） ======
+REPLY_CHUNK_LENGTH = 200
+LINE_MAX_REPLY_MESSAGES = 5
+SENTENCE_END_RE = re.compile(r'(?<=[。！？!?\n])')
+
+def split_reply(text, max_length=REPLY_CHUNK_LENGTH, max_messages=LINE_MAX_REPLY_MESSAGES):
+    # 大部分回覆都在上限內，直接整則送出不必逐句切
+    if len(text) <= max_length:
+        text = text.strip()
+        return [text] if text else []
+
+    chunks = []
+    current = ""
+    for sentence in SENTENCE_END_RE.split(text):
+        # 單句就超過上限時才硬切
+        while len(sentence) > max_length:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(sentence[:max_length])
+            sentence = sentence[max_length:]
+        if len(current) + len(sentence) > max_length:
+            chunks.append(current)
+            current = sentence
+        else:
+            current += sentence
+    if current:
+        chunks.append(current)
+
+    # 超過 5 則時，剩下的內容併入最後一則（單則文字上限 5000 字）
+    if len(chunks) > max_messages:
+        chunks = chunks[:max_messages - 1] + ["".join(chunks[max_messages - 1:])]
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
 # ====== LINE Webhook 接收點 ======
 @app.route("/callback", methods=['POST'])
 def callback():
@@ -178,10 +551,10 @@ def callback():
 @handler.add(MessageEvent, message=StickerMessage)
 def handle_sticker(event):
     user_id = event.source.user_id
-    print(f"🎨 收到貼圖：user_id={user_id}", flush=True)
+    logger.debug("🎨 收到貼圖：user_id=%s", user_id)
     line_bot_api.reply_message(
         event.reply_token,
-        TextSendMessage(text="謝謝你的貼圖！我無法直接回貼圖～✨ 有想聊睡眠拖延的內容，歡迎告訴我！")
+        STICKER_REPLY
     )
     
 @handler.add(MessageEvent, message=TextMessage)
@@ -189,36 +562,65 @@ def handle_message(event):
     user_id = event.source.user_id
     user_message = event.message.text.strip()
 
-    if user_id in user_lock and user_lock[user_id].is_alive():
-        print(f"⚠️ 忽略 {user_id} 的訊息：{user_message}（上一個請求尚未完成）")
+    # ====== 忽略含特定關鍵字的訊息 ======
+    if any(keyword in user_message for keyword in SKIP_KEYWORDS):
+        logger.debug("⏩ 略過訊息：%s（符合略過關鍵字）", user_message)
         return
 
-    user_lock[user_id] = threading.Thread(target=process_message, args=(user_id, user_message, event))
-    user_lock[user_id].start()
+    # ====== 上一則還在處理中：先暫存，處理完後合併成一次請求 ======
+    with busy_users_lock:
+        if user_id in busy_users:
+            pending_messages.setdefault(user_id, []).append((user_message, event))
+            logger.debug("⏳ 暫存 %s 的訊息：%s（上一個請求尚未完成）", user_id, user_message)
+            return
+        busy_users.add(user_id)
+
+    try:
+        job_queue.put_nowait((user_id, user_message, event))
+    except queue.Full:
+        with busy_users_lock:
+            busy_users.discard(user_id)
+        logger.warning("⚠️ 工作佇列已滿，忽略 %s 的訊息：%s", user_id, user_message)
 
 # ====== 處理訊息邏輯（快速 ChatGPT 模式） ======
-def process_message(user_id, user_message, event):
-    print(f"📩 處理訊息：user_id={user_id}, message={user_message}", flush=True)
+REVIEW_CODE_RE = re.compile(r"我要進行第.+?次(睡眠)?回顧\s+([A-Za-z0-9]{6})")
+NAME_RE = re.compile(r"我的姓名[:：]?\s*(.+)")
 
-    user_ref = db.collection("users").document(user_id)
+# 睡眠日記欄位
+MORNING_DATE_RE = re.compile(r'📖｜?(\d{1,2}/\d{1,2})')
+EVENING_DATE_RE = re.compile(r'📖睡眠日記｜?(\d{1,2}/\d{1,2})')
+WAKEUP_RE = re.compile(r"起床時間：(.+)")
+SLEEP_RE = re.compile(r"實際入睡時間：(.+)")
+ALERT_RE = re.compile(r"清醒感.*?：(\d+)")
+PLAN_RE = re.compile(r"預計入睡時間：(.+)")
+MOOD_RE = re.compile(r"(?:壓力|情緒).*?：(\d+)")
 
-    # ====== 忽略含特定關鍵字的訊息 ======
-    skip_keywords = [
-        "我要填寫睡眠日記～",
-        "第一次睡眠回顧將於4/27開放～",
-        "第二次睡眠回顧將於5/4開放～",
-        "第三次睡眠回顧將於5/11開放～","本實驗於4/21開始～"
-    ]
-    if any(keyword in user_message for keyword in skip_keywords):
-        print(f"⏩ 略過訊息：{user_message}（符合略過關鍵字）", flush=True)
-        return
+def is_morning_diary(text):
+    return "起床時間：" in text and "實際入睡時間：" in text and "清醒感" in text
+
+def is_evening_diary(text):
+    return "預計入睡時間：" in text and ("壓力" in text or "情緒" in text)
+
+# 姓名與睡眠日記只看單則訊息（姓名比對開頭、日記只記一種），不能和其他訊息合併
+def is_command_message(text):
+    return bool(NAME_RE.match(text)) or is_morning_diary(text) or is_evening_diary(text)
+
+# ====== 子目標完成標記（目標1～5） ======
+SUBGOAL_MARKER = "✅ 已完成目標 "
+SUBGOAL_MARKERS = [(i, f"{SUBGOAL_MARKER}{i}") for i in range(1, 6)]
+
+def process_message(user_id, user_message, event, release_user=lambda: None):
+    logger.debug("📩 處理訊息：user_id=%s, message=%s", user_id, user_message)
+    replied = False
+
+    user_ref = get_db().collection("users").document(user_id)
 
     # ====== 若使用者輸入「我的姓名XXX」或「我的姓名：XXX」，紀錄至 Firebase ======
-    name_match = re.match(r"我的姓名[:：]?\s*(.+)", user_message)
+    name_match = NAME_RE.match(user_message)
     if name_match:
         name = name_match.group(1).strip()
         user_ref.set({"name": name}, merge=True)  # ✅ 安全寫法：自動建立文件 + 更新欄位
-        print(f"📌 已紀錄 {user_id} 的姓名為：{name}", flush=True)
+        logger.info("📌 已紀錄 %s 的姓名為：%s", user_id, name)
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text=f"你好，{name}！已成功紀錄你的姓名 ☀️")
@@ -227,82 +629,110 @@ def process_message(user_id, user_message, event):
 
 
     try:
+        # 先判斷是否輸入回顧代碼，才能和使用者文件一起讀取 prompt
+        # 大部分訊息不含「回顧」，先用子字串檢查略過 regex
+        match = REVIEW_CODE_RE.search(user_message) if "回顧" in user_message else None
+        prompt_ref = None
+        prompt_doc = None
+        if match and review_prompt_cache.get(match.group(2).upper()) is None:
+            prompt_ref = get_db().collection("review_prompts").document(match.group(2).upper())
+
         # 取得使用者歷史對話與狀態
-        user_ref = db.collection("users").document(user_id)
-        user_doc = user_ref.get()
+        with span("firestore_read", user_id):
+            cached_user_data = user_state_cache.get(user_id)
+            if cached_user_data is not None:
+                user_exists = True
+                user_data = dict(cached_user_data)
+            else:
+                # 使用者文件與回顧 prompt 用一次 get_all 讀取（回傳順序不固定，依路徑對應）
+                refs = [user_ref, prompt_ref] if prompt_ref else [user_ref]
+                snapshots = {
+                    snap.reference.path: snap
+                    for snap in get_db().get_all(refs, field_paths=USER_DOC_FIELDS + ["prompt"])
+                }
+                user_doc = snapshots[user_ref.path]
+                if prompt_ref:
+                    prompt_doc = snapshots[prompt_ref.path]
+                user_exists = user_doc.exists
+                user_data = user_doc.to_dict() if user_exists else {}
+            messages = load_recent_messages(user_ref, user_exists)
 
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            messages = user_data.get("messages", [])
-        else:
-            user_data = {}
-            messages = []
+        # 加入最新訊息（時間戳用於子集合排序）
+        user_entry = {"role": "user", "content": user_message, "create_at": datetime.now(timezone.utc)}
+        messages.append(user_entry)
 
-        # 加入最新訊息
-        messages.append({"role": "user", "content": user_message})
+        # 本次要寫回使用者文件的欄位，最後與其他寫入一起 commit
+        user_update = {}
 
         # ====== 條件判斷：是否輸入「我要進行第X次睡眠回顧 代碼」 ======
         review_prompt = ""
         review_code = ""
-        match = re.search(r"我要進行第.+?次(睡眠)?回顧\s+([A-Za-z0-9]{6})", user_message)
         if match:
             review_code = match.group(2).upper()
-            print(f"🔍 偵測到回顧代碼：{review_code}", flush=True)
+            logger.info("🔍 偵測到回顧代碼：%s", review_code)
             try:
-                prompt_doc = db.collection("review_prompts").document(review_code).get()
-                if prompt_doc.exists:
-                    review_prompt = prompt_doc.to_dict().get("prompt", "")
-                    print(f"✅ 讀取 review_prompts/{review_code} 的 prompt 成功", flush=True)
-                    user_ref.update({"current_review_code": review_code})
+                prompt = get_review_prompt(review_code, prompt_doc)
+                if prompt is not None:
+                    review_prompt = prompt
+                    logger.debug("✅ 讀取 review_prompts/%s 的 prompt 成功", review_code)
+                    user_update["current_review_code"] = review_code
                 else:
-                    print(f"⚠️ 未找到代碼 {review_code} 的 prompt 文件", flush=True)
+                    logger.warning("⚠️ 未找到代碼 %s 的 prompt 文件", review_code)
             except Exception as e:
-                print(f"❌ 讀取 review_prompts/{review_code} 發生錯誤：{e}", flush=True)
+                logger.error("❌ 讀取 review_prompts/%s 發生錯誤：%s", review_code, e)
         else:
             review_code = user_data.get("current_review_code", "")
             if review_code:
                 try:
-                    prompt_doc = db.collection("review_prompts").document(review_code).get()
-                    if prompt_doc.exists:
-                        review_prompt = prompt_doc.to_dict().get("prompt", "")
-                        print(f"📌 使用儲存中的回顧代碼：{review_code}", flush=True)
+                    prompt = get_review_prompt(review_code)
+                    if prompt is not None:
+                        review_prompt = prompt
+                        logger.debug("📌 使用儲存中的回顧代碼：%s", review_code)
                 except Exception as e:
-                    print(f"❌ 讀取現有回顧代碼發生錯誤：{e}", flush=True)
+                    logger.error("❌ 讀取現有回顧代碼發生錯誤：%s", e)
             else:
-                print("🕊️ 沒有偵測到回顧代碼關鍵字，也沒有使用中回顧", flush=True)
+                logger.debug("🕊️ 沒有偵測到回顧代碼關鍵字，也沒有使用中回顧")
 
         # ====== 組合對話歷史並加入 system prompt ======
-        system_prompt = {
-            "role": "system",
-            "content": review_prompt + "\n" + DEFAULT_SYSTEM_PROMPT if review_prompt else DEFAULT_SYSTEM_PROMPT
-        }
-
+        # 回顧 prompt 放在預設規則之前（研究進行中，勿更動指令順序）
+        if review_prompt:
+            system_prompt = {"role": "system", "content": review_prompt + "\n" + DEFAULT_SYSTEM_PROMPT}
+        else:
+            system_prompt = DEFAULT_SYSTEM_MESSAGE
 
-        history_for_chat = [system_prompt]
+        # 由新到舊挑選，總字數不超過 3000，最後反轉回時間順序
+        kept = []
         total_chars = 0
         for m in reversed(messages):
             total_chars += len(m["content"])
             if total_chars > 3000:
                 break
-            history_for_chat.insert(1, {"role": m["role"], "content": m["content"]})
+            kept.append({"role": m["role"], "content": m["content"]})
+        history_for_chat = [system_prompt] + kept[::-1]
 
         # ====== 呼叫 ChatGPT 回覆 ======
-        assistant_reply = run_chat_completion(history_for_chat)
+        with span("openai_chat", user_id):
+            assistant_reply = run_chat_completion(history_for_chat)
         assistant_reply = remove_markdown(assistant_reply)
 
-        messages.append({"role": "assistant", "content": assistant_reply})
-        user_ref.set({"messages": messages}, merge=True)
+        assistant_entry = {"role": "assistant", "content": assistant_reply, "create_at": datetime.now(timezone.utc)}
+        # 每則訊息各存成一份子集合文件，寫入量與歷史長度無關
+        batch = get_db().batch()
+        messages_ref = user_ref.collection("messages")
+        batch.set(messages_ref.document(), user_entry)
+        batch.set(messages_ref.document(), assistant_entry)
 
         # ====== 額外記錄子目標完成狀態（目標1～5） ======
         subgoal_completed = None
-        for i in range(1, 6):
-            if f"✅ 已完成目標 {i}" in assistant_reply:
-                subgoal_completed = i
-                break
+        if SUBGOAL_MARKER in assistant_reply:
+            for i, marker in SUBGOAL_MARKERS:
+                if marker in assistant_reply:
+                    subgoal_completed = i
+                    break
 
         if subgoal_completed and review_code:
-            review_ref = db.collection("review_status").document(user_id)
-            review_ref.set({
+            review_ref = get_db().collection("review_status").document(user_id)
+            batch.set(review_ref, {
                 review_code: {
                     f"goal_{subgoal_completed}": {
                         "completed": True,
@@ -310,96 +740,194 @@ def process_message(user_id, user_message, event):
                     }
                 }
             }, merge=True)
-            print(f"📝 已記錄 {user_id} 完成 {review_code} 的目標 {subgoal_completed}", flush=True)
+            logger.info("📝 已記錄 %s 完成 %s 的目標 %s", user_id, review_code, subgoal_completed)
 
-                # ====== 判斷是否為睡眠日記回報並記錄至 Google Sheet ======
-        from datetime import datetime
+        # ====== 若整個回顧結束，清除 current_review_code ======
+        if "✅ 本次睡眠回顧已順利完成" in assistant_reply and review_code:
+            user_update["current_review_code"] = firestore.DELETE_FIELD
+            logger.info("🧹 已清除 %s 的 current_review_code（回顧完成）", user_id)
+
+        # ====== 一次送出本輪所有 Firestore 寫入（背景進行，與 LINE 回覆同時送出） ======
+        if user_update or not user_exists:
+            batch.set(user_ref, user_update, merge=True)
+        commit_future = io_executor.submit(batch.commit)
+
+        # 本輪寫入同步反映到快取
+        for field, value in user_update.items():
+            if value is firestore.DELETE_FIELD:
+                user_data.pop(field, None)
+            else:
+                user_data[field] = value
+        # 存副本：之後寫日記時 get_display_name 會改動 user_data，不能影響下一則訊息讀到的快取
+        user_state_cache.set(user_id, dict(user_data))
+
+        # ====== 回覆訊息給 LINE（切段） ======
+        # 回覆是空白時 split_reply 會回傳空列表，LINE 不接受空的回覆，改請使用者重傳
+        chunks = split_reply(assistant_reply) or [RETRY_REPLY_TEXT]
+        reply_messages = [TextSendMessage(text=chunk) for chunk in chunks]
+        with span("line_reply", user_id):
+            line_bot_api.reply_message(event.reply_token, reply_messages)
+        replied = True
+
+        with span("firestore_commit_wait", user_id):
+            commit_future.result()
 
+        # 回覆與對話紀錄都已完成，之後的 Google Sheet 紀錄不必佔住這位使用者，讓下一則訊息先開始處理
+        # （日記的查列與寫入由 diary_write_lock 序列化，兩個工作重疊也不會重複新增列）
+        release_user()
+
+        # ====== 判斷是否為睡眠日記回報並記錄至 Google Sheet ======
         try:
             # 判斷早上記錄格式
-            if "起床時間：" in user_message and "實際入睡時間：" in user_message and "清醒感" in user_message:
-                date_match = re.search(r'📖｜?(\d{1,2}/\d{1,2})', user_message)
+            if is_morning_diary(user_message):
+                date_match = MORNING_DATE_RE.search(user_message)
                 date_str = date_match.group(1) if date_match else datetime.now().strftime("%-m/%-d")
-                wakeup = re.search(r"起床時間：(.+)", user_message)
-                sleep = re.search(r"實際入睡時間：(.+)", user_message)
-                alert = re.search(r"清醒感.*?：(\d+)", user_message)
-
-                rows = worksheet.get_all_records()
-                display_name = line_bot_api.get_profile(user_id).display_name
-
-                row_idx = None
-                for idx, row in enumerate(rows, start=2):
-                    if row.get("user_id") == user_id and row.get("日期") == date_str:
-                        row_idx = idx
-                        break
-
-                if row_idx:
-                    worksheet.update(f"E{row_idx}", wakeup.group(1) if wakeup else "")
-                    worksheet.update(f"F{row_idx}", sleep.group(1) if sleep else "")
-                    worksheet.update(f"G{row_idx}", alert.group(1) if alert else "")
-                else:
-                    new_row = ["", display_name, user_id, date_str,
+                wakeup = WAKEUP_RE.search(user_message)
+                sleep = SLEEP_RE.search(user_message)
+                alert = ALERT_RE.search(user_message)
+
+                worksheet = get_worksheet()
+                with diary_write_lock:
+                    row_idx = find_diary_row(worksheet, user_id, date_str)
+
+                    if row_idx:
+                        # E～G 三欄一次更新，只送一個請求
+                        worksheet.update(f"E{row_idx}:G{row_idx}", [[
                             wakeup.group(1) if wakeup else "",
                             sleep.group(1) if sleep else "",
                             alert.group(1) if alert else "",
-                            "", ""]
-                    worksheet.append_row(new_row)
-                print(f"📊 已紀錄早上睡眠日記：{user_id} {date_str}")
+                        ]])
+                    else:
+                        display_name = get_display_name(user_id, user_ref, user_data)
+                        new_row = ["", display_name, user_id, date_str,
+                                wakeup.group(1) if wakeup else "",
+                                sleep.group(1) if sleep else "",
+                                alert.group(1) if alert else "",
+                                "", ""]
+                        append_diary_row(worksheet, user_id, date_str, new_row)
+                logger.info("📊 已紀錄早上睡眠日記：%s %s", user_id, date_str)
 
             # 判斷晚上記錄格式
-            elif "預計入睡時間：" in user_message and ("壓力" in user_message or "情緒" in user_message):
-                date_match = re.search(r'📖睡眠日記｜?(\d{1,2}/\d{1,2})', user_message)
+            elif is_evening_diary(user_message):
+                date_match = EVENING_DATE_RE.search(user_message)
                 date_str = date_match.group(1) if date_match else datetime.now().strftime("%-m/%-d")
-                plan = re.search(r"預計入睡時間：(.+)", user_message)
-                mood = re.search(r"(?:壓力|情緒).*?：(\d+)", user_message)
-
-                rows = worksheet.get_all_records()
-                display_name = line_bot_api.get_profile(user_id).display_name
+                plan = PLAN_RE.search(user_message)
+                mood = MOOD_RE.search(user_message)
 
-                row_idx = None
-                for idx, row in enumerate(rows, start=2):
-                    if row.get("user_id") == user_id and row.get("日期") == date_str:
-                        row_idx = idx
-                        break
+                worksheet = get_worksheet()
+                with diary_write_lock:
+                    row_idx = find_diary_row(worksheet, user_id, date_str)
 
-                if row_idx:
-                    worksheet.update(f"H{row_idx}", plan.group(1) if plan else "")
-                    worksheet.update(f"I{row_idx}", mood.group(1) if mood else "")
-                else:
-                    new_row = ["", display_name, user_id, date_str,
-                            "", "", "",
+                    if row_idx:
+                        worksheet.update(f"H{row_idx}:I{row_idx}", [[
                             plan.group(1) if plan else "",
-                            mood.group(1) if mood else ""]
-                    worksheet.append_row(new_row)
-                print(f"📊 已紀錄晚上睡眠日記：{user_id} {date_str}")
+                            mood.group(1) if mood else "",
+                        ]])
+                    else:
+                        display_name = get_display_name(user_id, user_ref, user_data)
+                        new_row = ["", display_name, user_id, date_str,
+                                "", "", "",
+                                plan.group(1) if plan else "",
+                                mood.group(1) if mood else ""]
+                        append_diary_row(worksheet, user_id, date_str, new_row)
+                logger.info("📊 已紀錄晚上睡眠日記：%s %s", user_id, date_str)
         except Exception as e:
-            print(f"❌ Google Sheets 紀錄失敗：{e}")
+            logger.error("❌ Google Sheets 紀錄失敗：%s", e)
 
+    except Exception:
+        logger.exception("❌ 處理訊息發生錯誤 user_id=%s", user_id)
+        # 快取可能比 Firestore 新，下次重新讀取
+        user_state_cache.pop(user_id)
+        # reply token 只能用一次，已回覆過就不再送錯誤訊息
+        if not replied:
+            line_bot_api.reply_message(event.reply_token, ERROR_REPLY)
 
-        # ====== 若整個回顧結束，清除 current_review_code ======
-        if "✅ 本次睡眠回顧已順利完成" in assistant_reply and review_code:
-            user_ref.update({"current_review_code": firestore.DELETE_FIELD})
-            print(f"🧹 已清除 {user_id} 的 current_review_code（回顧完成）", flush=True)
 
-        # ====== 回覆訊息給 LINE（切段） ======
-        max_length = 200
-        reply_messages = [
-            TextSendMessage(text=assistant_reply[i:i + max_length])
-            for i in range(0, len(assistant_reply), max_length)
-        ]
-        line_bot_api.reply_message(event.reply_token, reply_messages)
-
-    except Exception as e:
-        print("❌ 發生錯誤：", flush=True)
-        traceback.print_exc()
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❗安昕暫時無法使用，請稍後再試"))
-    finally:
-        if user_id in user_lock:
-            del user_lock[user_id]
+def message_worker():
+    while True:
+        user_id, user_message, event = job_queue.get()
+        released = []
+
+        # 釋放使用者只能做一次：process_message 可能提早呼叫，finally 再保底
+        def release_user():
+            if not released:
+                released.append(True)
+                finish_user(user_id)
+
+        try:
+            user_message, event = debounce_messages(user_id, user_message, event)
+            process_message(user_id, user_message, event, release_user)
+        except Exception:
+            logger.exception("❌ 背景工作發生錯誤 user_id=%s", user_id)
+        finally:
+            release_user()
+            job_queue.task_done()
+
+# 稍等一下，把使用者連續送出的一般訊息併成同一次請求；指令訊息一律單獨處理，不必等待
+def debounce_messages(user_id, user_message, event):
+    if MESSAGE_DEBOUNCE_SECONDS <= 0 or is_command_message(user_message):
+        return user_message, event
+    time.sleep(MESSAGE_DEBOUNCE_SECONDS)
+    return take_pending_messages(user_id, [(user_message, event)])
+
+# 把暫存的訊息接在 messages 後面合併成一則，回傳 (合併後文字, 最新一則的 event)
+# 指令訊息（姓名、睡眠日記）單獨成一個工作；一般訊息合併到下一則指令之前，其餘留在暫存等下一輪
+def take_pending_messages(user_id, messages):
+    with busy_users_lock:
+        queued = messages + pending_messages.pop(user_id, [])
+        count = 1
+        if not is_command_message(queued[0][0]):
+            while count < len(queued) and not is_command_message(queued[count][0]):
+                count += 1
+        messages, rest = queued[:count], queued[count:]
+        if rest:
+            pending_messages[user_id] = rest
+    if len(messages) > 1:
+        logger.info("📦 合併 %s 暫存的 %d 則訊息", user_id, len(messages))
+    merged_message = "\n".join(message for message, _ in messages)
+    return merged_message, messages[-1][1]  # 用最新一則的 reply token 回覆
+
+# 一則處理完後，把期間累積的訊息合併成一個工作；沒有暫存訊息才釋放使用者
+def finish_user(user_id):
+    with busy_users_lock:
+        if not pending_messages.get(user_id):
+            pending_messages.pop(user_id, None)
+            busy_users.discard(user_id)
+            return
+
+    merged_message, latest_event = take_pending_messages(user_id, [])
+    try:
+        job_queue.put_nowait((user_id, merged_message, latest_event))
+    except queue.Full:
+        with busy_users_lock:
+            busy_users.discard(user_id)
+        logger.warning("⚠️ 工作佇列已滿，忽略 %s 暫存的訊息：%s", user_id, merged_message)
+
+for worker_number in range(WORKER_COUNT):
+    threading.Thread(target=message_worker, name=f"msg-worker-{worker_number}", daemon=True).start()
+
+
+# ====== 冷啟動預熱：背景先完成各服務初始化與 TLS 連線，第一則訊息不必等待 ======
+def warm_up_connections():
+    steps = [
+        ("openai", lambda: get_openai_client().models.list()),
+        ("firestore", lambda: get_db().collection("users").limit(1).get()),
+        ("line", line_bot_api.get_bot_info),
+        ("sheets", get_worksheet),
+    ]
+    for name, step in steps:
+        try:
+            with span(f"warmup_{name}"):
+                step()
+        except Exception:
+            logger.exception("⚠️ 預熱 %s 失敗", name)
+
+if os.getenv("WARMUP_ON_START", "1") == "1":
+    threading.Thread(target=warm_up_connections, daemon=True).start()
 
 
 # ====== 啟動應用程式 ======
 if __name__ == "__main__":
     port = int(os.getenv('PORT', 8080))
-    print(f"🚀 應用程式啟動中，監聽埠號 {port}...")
+    logger.info("🚀 應用程式啟動中，監聽埠號 %s...", port)
     app.run(host='0.0.0.0', port=port)
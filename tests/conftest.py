@@ -0,0 +1,12 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app.py 載入時就會檢查環境變數，測試用假值即可（不會真的連線）
+os.environ.setdefault("CHANNEL_ACCESS_TOKEN", "test-token")
+os.environ.setdefault("CHANNEL_SECRET", "test-secret")
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ.setdefault("GOOGLE_SHEETS_KEY", "{}")
+os.environ.setdefault("FIREBASE_CREDENTIALS", "{}")
+os.environ.setdefault("WARMUP_ON_START", "0")
@@ -0,0 +1,94 @@
+import re
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+import app
+
+HEADER = ["", "名稱", "user_id", "日期", "起床時間", "實際入睡時間", "清醒感", "預計入睡時間", "壓力/情緒"]
+MORNING_DIARY = "📖｜4/27\n起床時間：07:00\n實際入睡時間：01:00\n清醒感（5分制）：3"
+EVENING_DIARY = "📖睡眠日記｜4/27\n預計入睡時間：23:30\n壓力/情緒（5分制）：4"
+
+
+# 只實作 app 用到的 gspread Worksheet 方法；讀寫前稍等，讓並行的工作有機會交錯
+class FakeWorksheet:
+    def __init__(self, rows=()):
+        self.rows = [HEADER] + [list(row) for row in rows]
+        self.full_reads = 0
+
+    def get_all_values(self):
+        self.full_reads += 1
+        time.sleep(0.02)
+        return [list(row) for row in self.rows]
+
+    def get(self, cell_range):
+        row_number = int(re.match(r"C(\d+):", cell_range).group(1))
+        if row_number > len(self.rows):
+            return []
+        return [self.rows[row_number - 1][2:4]]
+
+    def update(self, cell_range, values):
+        pass
+
+    def append_row(self, row):
+        time.sleep(0.02)
+        self.rows.append(list(row))
+        return {"updates": {"updatedRange": f"sleep_diary!A{len(self.rows)}:I{len(self.rows)}"}}
+
+
+@pytest.fixture(autouse=True)
+def empty_index(monkeypatch):
+    monkeypatch.setattr(app, "diary_row_index", {})
+    monkeypatch.setattr(app, "diary_row_index_loaded_at", 0.0)
+
+
+def test_index_hit_is_verified_without_full_download():
+    worksheet = FakeWorksheet([["", "王", "U1", "4/27"]])
+    assert app.find_diary_row(worksheet, "U1", "4/27") == 2
+    assert app.find_diary_row(worksheet, "U1", "4/27") == 2
+    assert worksheet.full_reads == 1
+
+
+def test_changed_row_rebuilds_index():
+    worksheet = FakeWorksheet([["", "王", "U1", "4/27"], ["", "李", "U2", "4/27"]])
+    assert app.find_diary_row(worksheet, "U1", "4/27") == 2
+    # 研究人員排序後，原本的第 2 列變成另一位受測者
+    worksheet.rows[1], worksheet.rows[2] = worksheet.rows[2], worksheet.rows[1]
+    assert app.find_diary_row(worksheet, "U1", "4/27") == 3
+    assert worksheet.full_reads == 2
+
+
+def test_appended_row_is_indexed():
+    worksheet = FakeWorksheet()
+    assert app.find_diary_row(worksheet, "U1", "4/27") is None
+    app.append_diary_row(worksheet, "U1", "4/27", ["", "王", "U1", "4/27", "", "", "", "", ""])
+    assert app.find_diary_row(worksheet, "U1", "4/27") == 2
+    assert worksheet.full_reads == 1
+
+
+def test_concurrent_same_date_reports_append_one_row():
+    worksheet = FakeWorksheet()
+    db = mock.Mock()
+    user_doc = mock.Mock(exists=False)
+    user_doc.reference.path = db.collection.return_value.document.return_value.path
+    db.get_all.return_value = [user_doc]
+    event = mock.Mock(reply_token="token")
+
+    with mock.patch.object(app, "get_db", return_value=db), \
+            mock.patch.object(app, "get_worksheet", return_value=worksheet), \
+            mock.patch.object(app, "load_recent_messages", return_value=[]), \
+            mock.patch.object(app, "run_chat_completion", return_value="收到囉！"), \
+            mock.patch.object(app, "get_display_name", return_value="王"), \
+            mock.patch.object(app.line_bot_api, "reply_message"):
+        threads = [
+            threading.Thread(target=app.process_message, args=("U-race", text, event))
+            for text in (MORNING_DIARY, EVENING_DIARY)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert [row[2:4] for row in worksheet.rows[1:]] == [["U-race", "4/27"]]
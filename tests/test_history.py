@@ -0,0 +1,30 @@
+from unittest import mock
+
+import app
+
+
+def make_user_ref(user_id, subcollection, legacy):
+    user_ref = mock.Mock()
+    user_ref.id = user_id
+    snaps = [mock.Mock(to_dict=mock.Mock(return_value=m)) for m in reversed(subcollection)]
+    user_ref.collection.return_value.order_by.return_value.limit.return_value.get.return_value = snaps
+    user_ref.get.return_value.to_dict.return_value = {"messages": legacy}
+    return user_ref
+
+
+def test_legacy_messages_fill_the_window_before_subcollection():
+    user_ref = make_user_ref("U-history-1", [{"content": "new"}], [{"content": "old"}])
+    assert app.load_recent_messages(user_ref, True) == [{"content": "old"}, {"content": "new"}]
+
+
+def test_legacy_array_is_read_once_per_user():
+    user_ref = make_user_ref("U-history-2", [{"content": "new"}], [])
+    app.load_recent_messages(user_ref, True)
+    app.load_recent_messages(user_ref, True)
+    assert user_ref.get.call_count == 1
+
+
+def test_new_user_skips_legacy_read():
+    user_ref = make_user_ref("U-history-3", [], [])
+    assert app.load_recent_messages(user_ref, False) == []
+    user_ref.get.assert_not_called()
@@ -0,0 +1,28 @@
+import re
+
+import pytest
+
+from app import remove_markdown
+
+
+# 原本逐一套用的三次替換，作為比對基準
+def reference_remove_markdown(text):
+    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
+    text = re.sub(r'\*(.*?)\*', r'\1', text)
+    text = re.sub(r'`(.*?)`', r'\1', text)
+    return text
+
+
+@pytest.mark.parametrize("text", [
+    "***x***",
+    "**`x`**",
+    "*a **b** c*",
+    "今晚試試 **提早 30 分鐘** 放鬆 😊",
+    "沒有任何格式的回覆",
+])
+def test_matches_reference(text):
+    assert remove_markdown(text) == reference_remove_markdown(text)
+
+
+def test_bold_italic_is_fully_stripped():
+    assert remove_markdown("***x***") == "x"
@@ -0,0 +1,63 @@
+import pytest
+
+import app
+
+MORNING_DIARY = "📖｜4/27\n起床時間：07:00\n實際入睡時間：01:00\n清醒感（5分制）：3"
+EVENING_DIARY = "📖睡眠日記｜4/27\n預計入睡時間：23:30\n壓力/情緒（5分制）：4"
+
+
+@pytest.fixture(autouse=True)
+def clear_pending():
+    app.pending_messages.clear()
+    yield
+    app.pending_messages.clear()
+
+
+# 模擬 worker 一輪輪取出暫存訊息，回傳每個工作處理的文字
+def drain(user_id, texts):
+    first, *rest = [(text, f"event-{i}") for i, text in enumerate(texts)]
+    app.pending_messages[user_id] = rest
+    jobs = []
+    messages = [first]
+    while True:
+        text, event = app.take_pending_messages(user_id, messages)
+        jobs.append(text)
+        messages = []
+        if not app.pending_messages.get(user_id):
+            return jobs
+
+
+def test_plain_messages_are_merged():
+    assert drain("U1", ["你好", "最近很晚睡"]) == ["你好\n最近很晚睡"]
+
+
+def test_name_after_chat_runs_as_its_own_job():
+    assert drain("U1", ["你好", "我的姓名 王"]) == ["你好", "我的姓名 王"]
+
+
+def test_chat_after_name_is_not_dropped():
+    assert drain("U1", ["我的姓名 王", "你好"]) == ["我的姓名 王", "你好"]
+
+
+def test_morning_and_evening_diaries_are_separate_jobs():
+    assert drain("U1", [MORNING_DIARY, EVENING_DIARY]) == [MORNING_DIARY, EVENING_DIARY]
+
+
+def test_latest_event_of_each_job_is_used():
+    app.pending_messages["U1"] = [("b", "event-1"), ("我的姓名 王", "event-2")]
+    assert app.take_pending_messages("U1", [("a", "event-0")]) == ("a\nb", "event-1")
+    assert app.take_pending_messages("U1", []) == ("我的姓名 王", "event-2")
+
+
+def test_debounce_merges_plain_messages_up_to_a_command(monkeypatch):
+    monkeypatch.setattr(app, "MESSAGE_DEBOUNCE_SECONDS", 0.01)
+    app.pending_messages["U1"] = [("最近很晚睡", "event-1"), (EVENING_DIARY, "event-2")]
+    assert app.debounce_messages("U1", "你好", "event-0") == ("你好\n最近很晚睡", "event-1")
+    assert app.pending_messages["U1"] == [(EVENING_DIARY, "event-2")]
+
+
+def test_debounce_skips_waiting_for_commands(monkeypatch):
+    monkeypatch.setattr(app, "MESSAGE_DEBOUNCE_SECONDS", 0.01)
+    app.pending_messages["U1"] = [("你好", "event-1")]
+    assert app.debounce_messages("U1", "我的姓名 王", "event-0") == ("我的姓名 王", "event-0")
+    assert app.pending_messages["U1"] == [("你好", "event-1")]
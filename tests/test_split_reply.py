@@ -0,0 +1,53 @@
+from unittest import mock
+
+import app
+from app import split_reply
+
+
+def test_short_reply_is_one_bubble():
+    text = "今晚試試提早 30 分鐘放鬆心情哦！你覺得呢？"
+    assert split_reply(text) == [text]
+
+
+def test_reply_at_limit_is_one_bubble():
+    text = "好" * 200
+    assert split_reply(text) == [text]
+
+
+def test_sentences_are_grouped_up_to_limit():
+    sentence = "好" * 99 + "。"
+    assert split_reply(sentence * 3) == [sentence * 2, sentence]
+
+
+def test_long_sentence_is_hard_cut():
+    text = "好" * 450
+    assert split_reply(text) == ["好" * 200, "好" * 200, "好" * 50]
+
+
+def test_overflow_is_merged_into_last_bubble():
+    sentence = "好" * 199 + "。"
+    chunks = split_reply(sentence * 7)
+    assert len(chunks) == 5
+    assert chunks[:4] == [sentence] * 4
+    assert chunks[4] == sentence * 3
+
+
+def test_whitespace_only_reply_is_empty():
+    assert split_reply("   \n ") == []
+
+
+def test_blank_completion_still_sends_a_reply():
+    db = mock.Mock()
+    user_doc = mock.Mock(exists=False)
+    user_doc.reference.path = db.collection.return_value.document.return_value.path
+    db.get_all.return_value = [user_doc]
+    event = mock.Mock(reply_token="token")
+
+    with mock.patch.object(app, "get_db", return_value=db), \
+            mock.patch.object(app, "load_recent_messages", return_value=[]), \
+            mock.patch.object(app, "run_chat_completion", return_value="  "), \
+            mock.patch.object(app.line_bot_api, "reply_message") as reply_message:
+        app.process_message("U-blank", "你好", event)
+
+    reply_message.assert_called_once()
+    assert [m.text for m in reply_message.call_args.args[1]] == [app.RETRY_REPLY_TEXT]
@@ -0,0 +1,6 @@
+import app
+
+
+def test_module_imports():
+    assert app.app is not None
+    assert isinstance(app.line_bot_api.http_client, app.PooledRequestsHttpClient)